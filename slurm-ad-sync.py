@@ -3,8 +3,11 @@
 import re
 import subprocess
 import argparse
+import functools
+import ldb
+from dataclasses import dataclass, field
 from samba.auth import system_session
-from samba.credentials import Credentials
+from samba.credentials import Credentials, DONT_USE_KERBEROS
 from samba.param import LoadParm
 from samba.samdb import SamDB
 
@@ -14,164 +17,308 @@ PASSWORD = "-pass4Slurm-"
 DOMAIN = "grit.ucsb.edu"
 SERVER = "dc1.grit.ucsb.edu"
 BASE_DN = "ou=GRIT Users,dc=grit,dc=ucsb,dc=edu"
+PAGE_SIZE = 1000  # AD's default MaxPageSize
+CREATE_EMPTY_GROUPS = False  # Create Slurm accounts for AD groups with no members
+
+# Names are written unquoted into a sacctmgr script, so they must be a single token
+SLURM_NAME_PATTERN = re.compile(r"[^\s=,'\"]+")
+
+@functools.lru_cache(maxsize=None)
+def load_smb_conf():
+    """Parse smb.conf once and reuse the parameters for every connection."""
+    lp = LoadParm()
+    lp.load_default()
+    return lp
 
 def connect_to_ad(service_account, password, domain, server):
-    """Connect to AD using Samba Python bindings."""
+    """Connect to AD using Samba Python bindings.
+
+    The returned SamDB is a single LDAP connection; pass it to every search
+    instead of reconnecting.
+    """
     try:
-        lp = LoadParm()
-        lp.load_default()
+        lp = load_smb_conf()
         creds = Credentials()
         creds.guess(lp)
         creds.set_username(service_account)
         creds.set_password(password)
         creds.set_domain(domain)
+        creds.set_kerberos_state(DONT_USE_KERBEROS)
         samdb = SamDB(url=f"ldap://{server}", session_info=system_session(), credentials=creds, lp=lp)
         return samdb
     except Exception as e:
         print(f"Error connecting to AD: {e}")
         return None
 
+def to_str(value):
+    """Decode an LDAP attribute value to str."""
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8')
+    return str(value)
+
+def paged_search(samdb, **kwargs):
+    """Run an LDAP search, following paged result cookies until exhausted."""
+    entries = []
+    cookie = ""
+    while True:
+        result = samdb.search(controls=[f"paged_results:1:{PAGE_SIZE}{cookie}"], **kwargs)
+        entries.extend(result)
+        cookie = ""
+        # The reply control renders as 'paged_results:<critical>:<cookie>'
+        for control in result.controls or []:
+            parts = str(control).split(":", 2)
+            if parts[0] == "paged_results" and len(parts) == 3 and parts[2]:
+                cookie = ":" + parts[2]
+        if not cookie:
+            return entries
+
+def find_range_key(entry, attr):
+    """Return the ranged form of attr (e.g. 'member;range=0-1499') if present."""
+    prefix = f"{attr};range=".lower()
+    for key in entry.keys():
+        if key.lower().startswith(prefix):
+            return key
+    return None
+
+def expand_ranged_members(samdb, group):
+    """Fetch the remaining member values of a group whose member list is range-limited."""
+    range_key = find_range_key(group, "member")
+    if range_key is None:
+        return
+
+    members = []
+    entry, key = group, range_key
+    while True:
+        members.extend(entry[key])
+        high = key.split("=", 1)[1].split("-", 1)[1]
+        if high == "*":
+            break
+        try:
+            result = samdb.search(
+                base=group.dn,
+                scope=ldb.SCOPE_BASE,
+                attrs=[f"member;range={int(high) + 1}-*"]
+            )
+        except ldb.LdbError as e:
+            print(f"Error fetching ranged members of {group.dn}: {e}; keeping {len(members)} members.")
+            break
+        if not result:
+            print(f"Ranged member search for {group.dn} returned nothing; keeping {len(members)} members.")
+            break
+        entry = result[0]
+        key = find_range_key(entry, "member")
+        if key is None:
+            break
+
+    del group[range_key]
+    group["member"] = ldb.MessageElement(members, ldb.FLAG_MOD_REPLACE, "member")
+
 def get_slurm_groups(samdb):
-    """Retrieve AD groups starting with 'slurm_'."""
+    """Retrieve AD groups starting with 'slurm_' as (name, member DNs) pairs of str."""
     try:
-        query = "(cn=slurm_*)"
-        groups = samdb.search(
+        query = "(&(objectClass=group)(cn=slurm_*))"
+        groups = paged_search(
+            samdb,
             base=BASE_DN,  # Use BASE_DN from the configuration
-            scope=2,
+            scope=ldb.SCOPE_SUBTREE,
             expression=query,
             attrs=["cn", "member", "sAMAccountName"]
         )
-        return groups
+        slurm_groups = []
+        for group in groups:
+            expand_ranged_members(samdb, group)
+            group_name = to_str(group["cn"][0])
+            members = [to_str(member) for member in group.get("member", [])]
+            slurm_groups.append((group_name, members))
+        return slurm_groups
     except Exception as e:
         print(f"Error querying AD groups: {e}")
         return []
 
-def slurm_group_exists(group_name):
-    """Check if a group already exists in Slurm."""
-    try:
-        result = subprocess.run(
-            ["sacctmgr", "list", "account", "format=Account,Cluster", "--parsable2"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        output = result.stdout
-        print(f"Checking existence of group '{group_name}'. Command output:\n{output}")
-        # Check if the group exists in any cluster
-        for line in output.splitlines():
-            account = line.split('|')[0]  # Extract the Account column
-            if account == group_name:
-                print(f"Group '{group_name}' found in line: {line}")
-                return True
-        return False
-    except subprocess.CalledProcessError as e:
-        print(f"Error checking Slurm group: {e}")
-        return False
+def get_member_search_bases(samdb, groups):
+    """Return the search bases needed to cover every group member DN.
 
-def slurm_user_exists(username):
-    """Check if a user already exists in Slurm."""
-    try:
-        result = subprocess.run(
-            ["sacctmgr", "list", "user", username, "format=User"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        output = result.stdout.decode('utf-8')
-        return username in output
-    except subprocess.CalledProcessError as e:
-        print(f"Error checking Slurm user: {e}")
-        return False
+    Also returns the set of member DNs that could not be parsed.
+    """
+    base_dn = ldb.Dn(samdb, BASE_DN)
+    bases = {str(base_dn).lower(): base_dn}
+    malformed = set()
+    for _, members in groups:
+        for member in members:
+            try:
+                member_dn = ldb.Dn(samdb, member)
+            except (ValueError, ldb.LdbError):
+                malformed.add(member)
+                continue
+            if member_dn.is_child_of(base_dn):
+                continue
+            parent = member_dn.parent()
+            bases.setdefault(str(parent).lower(), parent)
+
+    # A subtree search already covers nested OUs, so drop bases under another base
+    covering = [
+        base for key, base in bases.items()
+        if not any(other_key != key and base.is_child_of(other) for other_key, other in bases.items())
+    ]
+    return covering, malformed
+
+def get_user_names(samdb, bases):
+    """Map lowercased user DNs to sAMAccountName with one search per base."""
+    dn_to_sam = {}
+    for base in bases:
+        try:
+            users = paged_search(
+                samdb,
+                base=base,
+                scope=ldb.SCOPE_SUBTREE,
+                expression="(objectClass=user)",
+                attrs=["distinguishedName", "sAMAccountName"]
+            )
+        except Exception as e:
+            print(f"Error querying AD users under {base}: {e}")
+            continue
+        for user in users:
+            if "sAMAccountName" not in user or "distinguishedName" not in user:
+                continue
+            # Key on AD's own DN string so it matches the raw member values
+            dn = to_str(user["distinguishedName"][0]).lower()
+            dn_to_sam[dn] = to_str(user["sAMAccountName"][0])
+    return dn_to_sam
 
-def slurm_user_in_group(username, group_name):
-    """Check if a user's DefaultAccount is already set to the specified group."""
+@dataclass
+class SlurmState:
+    """Snapshot of existing Slurm accounts and user associations, loaded once per run.
+
+    slurmdbd stores account and user names in lowercase, so all keys are lowercased.
+    """
+    accounts: set = field(default_factory=set)
+    associations: set = field(default_factory=set)
+
+def run_sacctmgr_list(args):
+    """Run a read-only sacctmgr listing and return its non-empty output lines."""
+    result = subprocess.run(
+        ["sacctmgr", "-nP", "list", *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True
+    )
+    return [line for line in result.stdout.splitlines() if line]
+
+def load_slurm_state():
+    """Load all Slurm accounts and associations with a single sacctmgr call each."""
+    state = SlurmState()
     try:
-        result = subprocess.run(
-            ["sacctmgr", "list", "user", username, "format=DefaultAccount", "--parsable2"],
-            stdout=subprocess.PIPE,
-            text=True
-        )
-        output = result.stdout
-        print(f"Checking if user '{username}' is in group '{group_name}'. Command output:\n{output}")
-        # Parse the output to check if DefaultAccount matches the group_name
-        for line in output.splitlines():
-            if group_name == line.strip():
-                return True
-        return False
+        state.accounts = {account.lower() for account in run_sacctmgr_list(["account", "format=Account"])}
+        for line in run_sacctmgr_list(["assoc", "format=User,Account"]):
+            user, _, account = line.partition('|')
+            # Account-level associations have an empty User column
+            if user:
+                state.associations.add((user.lower(), account.lower()))
     except subprocess.CalledProcessError as e:
-        print(f"Error checking Slurm user-group association: {e}")
-        return False
+        print(f"Error loading Slurm state: {e}")
+        return None
+    return state
+
+def slurm_group_exists(state, group_name):
+    """Check if a group already exists in Slurm."""
+    return group_name in state.accounts
+
+def slurm_user_in_group(state, username, group_name):
+    """Check if a user already has an association with the specified group."""
+    return (username, group_name) in state.associations
+
+@dataclass
+class SlurmChanges:
+    """Pending sacctmgr mutations, applied together at the end of a run."""
+    add_accounts: list = field(default_factory=list)
+    add_users: list = field(default_factory=list)
+
+def is_valid_slurm_name(name):
+    """Check that a name can be passed to sacctmgr as a single bare token."""
+    return SLURM_NAME_PATTERN.fullmatch(name) is not None
+
+def add_to_slurmdbd(group_name, members, dn_to_sam, state, changes, verbose=False):
+    """Queue the Slurm changes needed to mirror an AD group and its members.
+
+    Returns the number of member DNs that could not be resolved to a username.
+    """
+    if not members and not CREATE_EMPTY_GROUPS:
+        if verbose:
+            print(f"Group '{group_name}' has no members, skipping.")
+        return 0
+
+    if not is_valid_slurm_name(group_name):
+        print(f"Skipping group '{group_name}': name is not a valid Slurm account name.")
+        return 0
+    # Match slurmdbd, which stores names in lowercase
+    group_name = group_name.lower()
+
+    # Check if the group already exists
+    if not slurm_group_exists(state, group_name):
+        changes.add_accounts.append(group_name)
+        state.accounts.add(group_name)
+    elif verbose:
+        print(f"Group '{group_name}' already exists in slurmdbd, skipping addition.")
+
+    # Add users to the group
+    unresolved = 0
+    for member in members:
+        # Look up the prefetched sAMAccountName for each member DN
+        username = dn_to_sam.get(member.lower())
+        if username is None:
+            unresolved += 1
+            continue
+        if not is_valid_slurm_name(username):
+            print(f"Skipping user '{username}' in group {group_name}: name is not a valid Slurm user name.")
+            continue
+        username = username.lower()
+
+        # 'add user' creates the user if needed, otherwise just the association
+        if not slurm_user_in_group(state, username, group_name):
+            changes.add_users.append((username, group_name))
+            state.associations.add((username, group_name))
+        elif verbose:
+            print(f"User {username} is already associated with group {group_name}.")
+    return unresolved
+
+def build_sacctmgr_script(changes):
+    """Render pending changes as sacctmgr commands, one per line."""
+    lines = [f"add account {name}" for name in changes.add_accounts]
+    lines += [f"add user {username} account={group_name}" for username, group_name in changes.add_users]
+    lines.append("quit")
+    return "\n".join(lines) + "\n"
+
+def apply_slurm_changes(changes, dry_run):
+    """Apply all pending changes in a single sacctmgr session."""
+    if not (changes.add_accounts or changes.add_users):
+        print("Slurm is already in sync with AD, nothing to do.")
+        return
+
+    script = build_sacctmgr_script(changes)
+    if dry_run:
+        print(f"[DRY RUN] Would run the following sacctmgr commands:\n{script}")
+        return
 
-def add_to_slurmdbd(group_name, members, dry_run, samdb):
-    """Add groups and users to Slurm database."""
     try:
-        # Ensure group_name is a string
-        if isinstance(group_name, bytes):
-            group_name = group_name.decode('utf-8')
-
-        # Check if the group already exists
-        if not slurm_group_exists(group_name):
-            if dry_run:
-                print(f"[DRY RUN] Would add group {group_name} to slurmdbd.")
-            else:
-                subprocess.run(["sacctmgr", "-i", "add", "account", group_name], check=True)
-                print(f"Added group {group_name} to slurmdbd.")
-        else:
-            print(f"Group '{group_name}' already exists in slurmdbd, skipping addition.")
-
-        # Add users to the group
-        for member in members:
-            # Query the sAMAccountName for each member DN
-            user_entry = samdb.search(base=member, scope=0, attrs=["sAMAccountName"])
-            username = extract_username(user_entry[0]) if user_entry else None
-
-            if username:
-                # Ensure username is a string
-                if isinstance(username, bytes):
-                    username = username.decode('utf-8')
-
-                if not slurm_user_exists(username):
-                    if dry_run:
-                        print(f"[DRY RUN] Would add user {username} to group {group_name}.")
-                    else:
-                        subprocess.run(["sacctmgr", "-i", "add", "user", username, "account=" + group_name], check=True)
-                        print(f"Added user {username} to group {group_name}.")
-                else:
-                    if not slurm_user_in_group(username, group_name):
-                        if dry_run:
-                            print(f"[DRY RUN] Would associate user {username} with group {group_name}.")
-                        else:
-                            subprocess.run(
-                                ["sacctmgr", "-i", "modify", "user", "where", f"name={username}", "set", f"DefaultAccount={group_name}"],
-                                check=True
-                            )
-                            print(f"Associated user {username} with group {group_name}.")
-                    else:
-                        print(f"User {username} is already associated with group {group_name}.")
+        subprocess.run(["sacctmgr", "-i"], input=script, text=True, check=True)
+        print(
+            f"Added {len(changes.add_accounts)} groups and "
+            f"{len(changes.add_users)} user associations to slurmdbd."
+        )
     except subprocess.CalledProcessError as e:
         print(f"Error updating slurmdbd: {e}")
 
-def extract_username(ad_entry):
-    """Extract sAMAccountName from an AD entry."""
-    try:
-        # Ensure we have the sAMAccountName attribute
-        if "sAMAccountName" in ad_entry:
-            username = ad_entry["sAMAccountName"][0]
-            return username
-        else:
-            print(f"No sAMAccountName found for entry: {ad_entry}")
-            return None
-    except Exception as e:
-        print(f"Error extracting sAMAccountName: {e}")
-        return None
-
 def main():
     """Main function to synchronize AD groups and users with Slurm."""
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Synchronize AD groups and users with Slurm.")
     parser.add_argument("--dry-run", action="store_true", help="Run in dry-run mode to preview changes.")
+    parser.add_argument("--verbose", action="store_true", help="Report groups and users that are already in sync.")
     args = parser.parse_args()
 
     dry_run = args.dry_run
+    verbose = args.verbose
 
     # Connect to AD
     samdb = connect_to_ad(SERVICE_ACCOUNT, PASSWORD, DOMAIN, SERVER)
@@ -185,11 +332,32 @@ def main():
         print("No slurm groups found in AD.")
         return
 
+    # Prefetch sAMAccountName for every user that can be a group member
+    bases, malformed = get_member_search_bases(samdb, groups)
+    if malformed:
+        print(f"Ignored {len(malformed)} group members with a malformed DN.")
+        groups = [
+            (group_name, [member for member in members if member not in malformed])
+            for group_name, members in groups
+        ]
+    dn_to_sam = get_user_names(samdb, bases)
+
+    # Load existing Slurm accounts and associations once
+    state = load_slurm_state()
+    if state is None:
+        print("Failed to load Slurm state. Exiting.")
+        return
+
     # Process each group
-    for group in groups:
-        group_name = group.get("cn")[0]
-        members = group.get("member", [])  # Get members, or an empty list if none
-        add_to_slurmdbd(group_name, members, dry_run, samdb)  # Pass samdb here
+    changes = SlurmChanges()
+    unresolved = 0
+    for group_name, members in groups:
+        unresolved += add_to_slurmdbd(group_name, members, dn_to_sam, state, changes, verbose)
+    if unresolved:
+        print(f"Skipped {unresolved} group members with no matching AD user.")
+
+    # Apply all changes in one sacctmgr invocation
+    apply_slurm_changes(changes, dry_run)
 
 if __name__ == "__main__":
     main()
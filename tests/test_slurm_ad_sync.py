@@ -0,0 +1,213 @@
+import importlib.util
+import subprocess
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("ldb")
+pytest.importorskip("samba")
+
+SCRIPT = Path(__file__).resolve().parent.parent / "slurm-ad-sync.py"
+spec = importlib.util.spec_from_file_location("slurm_ad_sync", SCRIPT)
+sync = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(sync)
+
+
+class FakeResult(list):
+    def __init__(self, entries, controls=None):
+        super().__init__(entries)
+        self.controls = controls or []
+
+
+class FakeEntry(dict):
+    def __init__(self, dn, attrs):
+        super().__init__(attrs)
+        self.dn = dn
+
+
+class FakeSamDB:
+    """Returns canned results in order and records every search call.
+
+    A canned result that is an exception is raised instead of returned.
+    """
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = []
+
+    def search(self, **kwargs):
+        self.calls.append(kwargs)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def test_paged_search_follows_cookies():
+    samdb = FakeSamDB([
+        FakeResult(["a", "b"], ["paged_results:0:AAEC"]),
+        FakeResult(["c"], ["paged_results:0:"]),
+    ])
+
+    entries = sync.paged_search(samdb, base="dc=example", expression="(objectClass=user)")
+
+    assert entries == ["a", "b", "c"]
+    assert samdb.calls[0]["controls"] == [f"paged_results:1:{sync.PAGE_SIZE}"]
+    assert samdb.calls[1]["controls"] == [f"paged_results:1:{sync.PAGE_SIZE}:AAEC"]
+    assert samdb.calls[1]["base"] == "dc=example"
+
+
+def test_paged_search_single_page():
+    samdb = FakeSamDB([FakeResult(["a"])])
+
+    assert sync.paged_search(samdb, base="dc=example") == ["a"]
+    assert len(samdb.calls) == 1
+
+
+def test_expand_ranged_members_fetches_all_ranges():
+    group = FakeEntry("cn=slurm_big", {"cn": [b"slurm_big"], "member;range=0-1": [b"cn=a", b"cn=b"]})
+    samdb = FakeSamDB([
+        FakeResult([FakeEntry("cn=slurm_big", {"member;range=2-3": [b"cn=c", b"cn=d"]})]),
+        FakeResult([FakeEntry("cn=slurm_big", {"member;range=4-*": [b"cn=e"]})]),
+    ])
+
+    sync.expand_ranged_members(samdb, group)
+
+    assert [call["attrs"] for call in samdb.calls] == [["member;range=2-*"], ["member;range=4-*"]]
+    assert "member;range=0-1" not in group
+    assert list(group["member"]) == [b"cn=a", b"cn=b", b"cn=c", b"cn=d", b"cn=e"]
+
+
+def test_expand_ranged_members_keeps_members_on_empty_follow_up():
+    group = FakeEntry("cn=slurm_big", {"member;range=0-1": [b"cn=a", b"cn=b"]})
+    samdb = FakeSamDB([FakeResult([])])
+
+    sync.expand_ranged_members(samdb, group)
+
+    assert list(group["member"]) == [b"cn=a", b"cn=b"]
+
+
+def test_expand_ranged_members_keeps_members_on_follow_up_error():
+    group = FakeEntry("cn=slurm_big", {"member;range=0-1": [b"cn=a", b"cn=b"]})
+    samdb = FakeSamDB([sync.ldb.LdbError(32, "No such object")])
+
+    sync.expand_ranged_members(samdb, group)
+
+    assert "member;range=0-1" not in group
+    assert list(group["member"]) == [b"cn=a", b"cn=b"]
+
+
+def test_expand_ranged_members_ignores_plain_member_attribute():
+    group = FakeEntry("cn=slurm_small", {"member": [b"cn=a"]})
+    samdb = FakeSamDB([])
+
+    sync.expand_ranged_members(samdb, group)
+
+    assert group["member"] == [b"cn=a"]
+    assert samdb.calls == []
+
+
+def test_build_sacctmgr_script_orders_accounts_before_users():
+    changes = sync.SlurmChanges(
+        add_accounts=["slurm_a", "slurm_b"],
+        add_users=[("alice", "slurm_a"), ("bob", "slurm_b")],
+    )
+
+    assert sync.build_sacctmgr_script(changes) == (
+        "add account slurm_a\n"
+        "add account slurm_b\n"
+        "add user alice account=slurm_a\n"
+        "add user bob account=slurm_b\n"
+        "quit\n"
+    )
+
+
+@pytest.mark.parametrize("name, valid", [
+    ("slurm_physics", True),
+    ("j.doe-2", True),
+    ("slurm_x y", False),
+    ("slurm_x\ty", False),
+    ("a=b", False),
+    ("a,b", False),
+    ("a'b", False),
+    ('a"b', False),
+    ("", False),
+])
+def test_is_valid_slurm_name(name, valid):
+    assert sync.is_valid_slurm_name(name) is valid
+
+
+def test_add_to_slurmdbd_queues_each_pair_once():
+    state = sync.SlurmState(accounts={"slurm_a"}, associations={("bob", "slurm_a")})
+    changes = sync.SlurmChanges()
+    dn_to_sam = {"cn=alice,ou=x": "Alice", "cn=bob,ou=x": "Bob"}
+
+    sync.add_to_slurmdbd("slurm_A", ["CN=Alice,OU=x", "cn=bob,ou=x"], dn_to_sam, state, changes)
+    sync.add_to_slurmdbd("slurm_a", ["cn=alice,ou=x"], dn_to_sam, state, changes)
+    sync.add_to_slurmdbd("slurm_b", ["cn=alice,ou=x"], dn_to_sam, state, changes)
+
+    assert changes.add_accounts == ["slurm_b"]
+    assert changes.add_users == [("alice", "slurm_a"), ("alice", "slurm_b")]
+
+
+def test_add_to_slurmdbd_counts_unresolved_and_skips_invalid_names():
+    state = sync.SlurmState()
+    changes = sync.SlurmChanges()
+    dn_to_sam = {"cn=odd,ou=x": "odd user"}
+
+    unresolved = sync.add_to_slurmdbd("slurm_a", ["cn=odd,ou=x", "cn=group,ou=x"], dn_to_sam, state, changes)
+    assert sync.add_to_slurmdbd("slurm bad", ["cn=odd,ou=x"], dn_to_sam, state, changes) == 0
+
+    assert unresolved == 1
+    assert changes.add_accounts == ["slurm_a"]
+    assert changes.add_users == []
+
+
+def test_add_to_slurmdbd_skips_empty_groups(monkeypatch):
+    state = sync.SlurmState()
+    changes = sync.SlurmChanges()
+
+    sync.add_to_slurmdbd("slurm_empty", [], {}, state, changes)
+    assert changes.add_accounts == []
+
+    monkeypatch.setattr(sync, "CREATE_EMPTY_GROUPS", True)
+    sync.add_to_slurmdbd("slurm_empty", [], {}, state, changes)
+    assert changes.add_accounts == ["slurm_empty"]
+
+
+def test_load_slurm_state_skips_account_level_associations(monkeypatch):
+    listings = {
+        "account": "root\nSlurm_A\n",
+        "assoc": "|root\n|slurm_a\nAlice|slurm_a\nbob|slurm_a\n",
+    }
+
+    def fake_run(args, **kwargs):
+        assert args[:3] == ["sacctmgr", "-nP", "list"]
+        return subprocess.CompletedProcess(args, 0, stdout=listings[args[3]], stderr="")
+
+    monkeypatch.setattr(sync.subprocess, "run", fake_run)
+
+    state = sync.load_slurm_state()
+
+    assert state.accounts == {"root", "slurm_a"}
+    assert state.associations == {("alice", "slurm_a"), ("bob", "slurm_a")}
+
+
+def test_get_member_search_bases_prunes_nested_bases_and_counts_malformed(monkeypatch):
+    monkeypatch.setattr(sync, "BASE_DN", "OU=Users,DC=example,DC=com")
+    groups = [
+        ("slurm_a", [
+            "CN=alice,OU=Users,DC=example,DC=com",
+            "CN=bob,OU=Staff,DC=example,DC=com",
+            "CN=carol,OU=Lab,OU=Staff,DC=example,DC=com",
+        ]),
+        ("slurm_b", ["not a dn", "CN=dave,OU=Lab,OU=Staff,DC=example,DC=com"]),
+    ]
+
+    bases, malformed = sync.get_member_search_bases(sync.ldb.Ldb(), groups)
+
+    assert {str(base).lower() for base in bases} == {
+        "ou=users,dc=example,dc=com",
+        "ou=staff,dc=example,dc=com",
+    }
+    assert malformed == {"not a dn"}